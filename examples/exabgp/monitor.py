@@ -43,23 +43,54 @@ If exabgp runs in a docker container, make sure to volume mount the monitor_dir
 """
 import argparse
 import asyncio
+import heapq
 import logging
 import logging.handlers
 import os
 import random
+import re
+import struct
 from dataclasses import dataclass, field
-from typing import Dict
+from typing import Dict, List, Tuple
 
 import sys
 import time
-from pyinotify import AsyncioNotifier, Event, EventsCodes, ProcessEvent, WatchManager
+from inotify_simple import INotify, flags
 
 _defaults = {'syslog': True,
              'debug': False,
              'monitor_dir': '/opt/frontend/monitor',
-             'timeout': 60,  # TODO: Re-implement the timeout functionality after moving to asyncio!
+             'timeout': 60,
              }
 
+# Events watched on the top level directory, to pick up new and removed instances
+_MONITOR_DIR_MASK = flags.CREATE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM | flags.ONLYDIR
+# Events watched on an instance directory until an announce file is moved or written into it
+_INSTANCE_DIR_MASK = flags.CREATE | flags.MOVED_TO | flags.ONLYDIR
+# Events watched on the announce file of an instance. IN_DELETE_SELF is only sent once the last
+# reference to the file is gone, which can be long after another file was renamed over it if the
+# old file is still open or has another link. The link count change (IN_ATTRIB) comes right away.
+_ANNOUNCE_FILE_MASK = flags.CLOSE_WRITE | flags.ATTRIB | flags.DELETE_SELF | flags.MOVE_SELF
+
+# Generator for the jitter added to poll timeouts, kept apart from the shared module level one
+_jitter = random.Random().random
+
+# struct inotify_event, minus the variable length name that follows it
+_INOTIFY_EVENT = struct.Struct('iIII')
+# Largest possible event, with a NAME_MAX long name and its NUL terminator
+_INOTIFY_EVENT_MAX = _INOTIFY_EVENT.size + 255 + 1
+# Room for plenty of events per read()
+_INOTIFY_BUFSIZE = 65536
+
+# Seconds to wait before reloading an announce file after an event, to coalesce bursts of updates
+_RELOAD_DELAY = 0.05
+
+# The lines of an announce file that are passed on to exabgp, all others are discarded
+_COMMAND_RE = re.compile(rb'^(?:announce|withdraw) [^\n]*\n?', re.MULTILINE)
+# Used to turn the commands sent to exabgp into withdrawals of the announced routes
+_WITHDRAW_LINE_RE = re.compile(rb'^withdraw [^\n]*\n?', re.MULTILINE)
+_ANNOUNCE_PREFIX_RE = re.compile(rb'^announce ', re.MULTILINE)
+
 
 def parse_args(defaults):
     parser = argparse.ArgumentParser(description = 'exabgp monitor for SUNET frontends',
@@ -116,22 +147,30 @@ def init_logger(myname, args):
 
 class InstanceDir(object):
 
+    # There is one of these per instance, so skip the per-object __dict__
+    __slots__ = ('dir', 'name', '_logger', '_timeout_ts', '_timeout', 'announce_fn', '_str', '_repr',
+                 '_contents', '_stat_key')
+
     def __init__(self, dir, timeout, logger):
         self.dir = dir
-        self.name = dir.split('/')[-1]
+        self.name = os.path.basename(dir)
         self._logger = logger
-        self._timeout_ts = time.time() + timeout + (random.random() * 5)  # fuzz poll timeouts a bit
+        self._timeout_ts = time.time() + timeout + (_jitter() * 5)  # fuzz poll timeouts a bit
         self._timeout = timeout
         self.announce_fn = os.path.join(self.dir, 'announce')
-        self._contents = None
-        if os.path.isfile(self.announce_fn):
-            self.reload()
+        # these are used in pretty much every log message, so only format them once
+        self._str = '<{}({})>'.format(self.__class__.__name__, self.name)
+        self._repr = '<{} instance at {:#x}: fn={})>'.format(self.__class__.__name__, id(self), self.announce_fn)
+        # the commands last sent to exabgp, as one blob so that comparing it with a reloaded file is cheap
+        self._contents = b''
+        self._stat_key = None
+        self.reload()
 
     def __repr__(self):
-        return '<{} instance at {:#x}: fn={})>'.format(self.__class__.__name__, id(self), self.announce_fn)
+        return self._repr
 
     def __str__(self):
-        return '<{}({})>'.format(self.__class__.__name__, self.name)
+        return self._str
 
     def reload(self):
         """
@@ -139,38 +178,61 @@ class InstanceDir(object):
 
         :return: True if file contents were updated, False otherwise. None on errors.
         """
-        #self._logger.debug('{}: Loading {}'.format(self, self.announce_fn))
         try:
-            with open(self.announce_fn) as fd:
-                # discard lines not starting with announce/withdraw
-                new = []
-                for this in fd.readlines():
-                    if this.startswith('announce ') or this.startswith('withdraw '):
-                        new += [this]
-                    else:
-                        self._logger.warning('{}: Discarded unknown command: {!r}'.format(self, this))
+            # Skip reading the file if it is unchanged since the last reload. The inode number is
+            # part of the key since announce files are normally replaced by renaming a new file over them.
+            st = os.stat(self.announce_fn)
+            stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if stat_key == self._stat_key:
+                return False
+            #self._logger.debug('%s: Loading %s', self, self.announce_fn)
+            with open(self.announce_fn, 'rb') as fd:
+                data = fd.read()
+        except FileNotFoundError:
+            self._logger.debug('%s: No announce file', self)
+            # Normally the watch on the file notices it being removed, but make sure nothing stays
+            # announced if that was missed
+            self.withdraw()
+            return None
         except IOError as exc:
-            self._logger.warning('Error reading announce file {}: {}'.format(self.announce_fn, exc))
+            self._logger.warning('Error reading announce file %s: %s', self.announce_fn, exc)
             return None
 
+        # discard lines not starting with announce/withdraw
+        commands = _COMMAND_RE.findall(data)
+        lines = data.count(b'\n')
+        if data and not data.endswith(b'\n'):
+            lines += 1
+        if len(commands) < lines:
+            self._logger.warning('%s: Discarded %d unknown command(s)', self, lines - len(commands))
+        new = b''.join(commands)
+
         if new != self._contents:
             if new:
-                parts = new[0].split(' ')
-                if parts[0] in ['announce', 'withdraw']:
-                    self._logger.info('{}: Announcement updated (first command: {})'.format(
-                        self, ' '.join(new[0].split(' ')[0:3])))
-                else:
-                    # Since only announce and withdraw lines are kept above, we only end up here if the
-                    # net result was an empty file. Don't want to crash though.
-                    self._logger.info('{}: Announcement updated'.format(self))
-                for line in new:
-                    self._logger.debug('  cmd: {!r}'.format(line))
-                    sys.stdout.write(line)
-                sys.stdout.flush()
+                if self._logger.isEnabledFor(logging.INFO):
+                    # Log the first three words of the first command. Only announce and withdraw lines
+                    # are kept above, so there is always at least one space in it.
+                    first = commands[0]
+                    end = first.find(b' ', first.find(b' ') + 1)
+                    if end != -1:
+                        end = first.find(b' ', end + 1)
+                    first = first[:end] if end != -1 else first.rstrip(b'\n')
+                    self._logger.info('%s: Announcement updated (first command: %s)',
+                                      self, first.decode(errors='backslashreplace'))
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    for line in commands:
+                        self._logger.debug('  cmd: %r', line)
+                # write all commands at once, straight to the binary buffer since they are already bytes.
+                # stdout is flushed by the caller, once for everything written in the same round of events.
+                sys.stdout.buffer.write(new)
             self._contents = new
+            # only remember the file as seen once its contents are dealt with, so that a failure
+            # above doesn't make the next reload skip it
+            self._stat_key = stat_key
             return True
         #else:
-        #    self._logger.debug('{}: No changes'.format(self))
+        #    self._logger.debug('%s: No changes', self)
+        self._stat_key = stat_key
         return False
 
     def withdraw(self):
@@ -180,16 +242,23 @@ class InstanceDir(object):
 
         :return:
         """
-        self._logger.info('{}: Withdrawing any previous announcements'.format(self))
-        new = []
-        for line in self._contents:
-            if line.startswith('announce '):
-                line = 'withdraw ' + line[9:]
-                self._logger.debug('  cmd: {!r}'.format(line))
-                sys.stdout.write(line)
-                new += [line]
-        sys.stdout.flush()
+        # drop the withdraw commands, and turn the announce commands into withdraw commands
+        new = _ANNOUNCE_PREFIX_RE.sub(b'withdraw ', _WITHDRAW_LINE_RE.sub(b'', self._contents))
+        if new:
+            self._logger.info('%s: Withdrawing any previous announcements', self)
+            if self._logger.isEnabledFor(logging.DEBUG):
+                for line in new.splitlines(keepends=True):
+                    self._logger.debug('  cmd: %r', line)
+            sys.stdout.buffer.write(new)
         self._contents = new
+        self._stat_key = None
+
+    @property
+    def next_poll(self):
+        """
+        Timestamp when the next scheduled poll of this instance is due.
+        """
+        return self._timeout_ts
 
     def poll(self, now):
         """
@@ -202,71 +271,285 @@ class InstanceDir(object):
         :param now: Current timestamp
         :return: None
         """
-        if now > self._timeout_ts:
-            inc = self._timeout + random.random() - 0.5
-            self._logger.debug('{}: Polling for changes (next timeout in {:.2f} seconds)'.format(self, inc))
+        if now >= self._timeout_ts:
+            # don't let a small --timeout minus the jitter make the next poll due right away again
+            inc = max(self._timeout + _jitter() - 0.5, 1.0)
+            self._logger.debug('%s: Polling for changes (next timeout in %.2f seconds)', self, inc)
             self._timeout_ts = now + inc
             if self.reload():
-                self._logger.warning('{}: Scheduled poll detected unexpected changes'.format(self))
+                self._logger.warning('%s: Scheduled poll detected unexpected changes', self)
 
 @dataclass
 class State:
     dirs: Dict[str, InstanceDir] = field(default_factory=dict)
+    # watch descriptor -> instance, for the watches on announce files
+    file_watches: Dict[int, InstanceDir] = field(default_factory=dict)
+    # watch descriptor -> instance, for the watches on instance directories without an announce file
+    dir_watches: Dict[int, InstanceDir] = field(default_factory=dict)
+    # instance directory -> watch descriptor of the watch in file_watches or dir_watches
+    watched: Dict[str, int] = field(default_factory=dict)
+    # instance directory -> scheduled reload of the announce file
+    pending: Dict[str, asyncio.TimerHandle] = field(default_factory=dict)
+    # heap of (next poll timestamp, instance directory) for the scheduled polls
+    due: List[Tuple[float, str]] = field(default_factory=list)
 
 
-class AnnounceEvent(ProcessEvent):
+class AnnounceWatcher(object):
 
     def __init__(self, args, logger, state: State):
-        super().__init__()
         self._args = args
         self._logger = logger
         self._state = state
+        self._loop = asyncio.get_event_loop()
+        self._inotify = INotify(nonblocking=True)
+        self._buf = bytearray(_INOTIFY_BUFSIZE)
+        self._monitor_wd = None
+        self._poll_handle = None
+        self._flush_handle = None
+
+    def start(self):
+        self._monitor_wd = self._inotify.add_watch(self._args.monitor_dir, _MONITOR_DIR_MASK)
+        self._loop.add_reader(self._inotify.fileno(), self._drain)
+        self._schedule_poll()
+
+    def stop(self):
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
+        self._loop.remove_reader(self._inotify.fileno())
+        self._inotify.close()
+
+    def add_instance(self, _dir):
+        _timeout = self._args.timeout + (_jitter() * 5) - 2.5  # spread polling intervals
+        this = InstanceDir(_dir, _timeout, self._logger)
+        self._state.dirs[_dir] = this
+        if self.watch(this):
+            # The announce file might have been moved into place after InstanceDir() loaded it, but
+            # before the watch was added
+            this.reload()
+        heapq.heappush(self._state.due, (this.next_poll, _dir))
+        if self._monitor_wd is not None and self._state.due[0][1] == _dir:
+            # the new instance is the next one due for a poll
+            self._schedule_poll()
+        return this
+
+    def scan(self):
+        """
+        Bring the set of instances in line with the directories in the top level directory,
+        adding new ones and removing those that are gone.
+
+        :return: The added instances
+        """
+        found = []
+        with os.scandir(self._args.monitor_dir) as it:
+            for entry in it:
+                # The file type comes with the directory entry, so this needs no stat(). Symlinks are
+                # skipped, like they are when they show up in the top level directory later on.
+                if entry.is_dir(follow_symlinks=False):
+                    found.append(entry.path)
+        present = set(found)
+        for this in [x for x in self._state.dirs.values() if x.dir not in present]:
+            self.remove_instance(this)
+        return [self.add_instance(_dir) for _dir in found if _dir not in self._state.dirs]
+
+    def remove_instance(self, this: InstanceDir):
+        if self._state.dirs.pop(this.dir, None) is None:
+            return
+        handle = self._state.pending.pop(this.dir, None)
+        if handle:
+            handle.cancel()
+        self.unwatch(this)
+        this.withdraw()
+        self._logger.info('Removed instance %s', this)
+
+    def watch(self, this: InstanceDir):
+        """
+        Watch the announce file of an instance if it exists, otherwise the instance directory
+        until an announce file is moved into it. Watching the file itself means we don't get
+        woken up by whatever else is going on in the instance directory.
+
+        :return: True if the announce file is watched, False if the directory is, None if neither exists
+        """
+        try:
+            wd = self._inotify.add_watch(this.announce_fn, _ANNOUNCE_FILE_MASK)
+            self._state.file_watches[wd] = this
+            self._state.watched[this.dir] = wd
+            return True
+        except OSError:
+            pass
+        try:
+            wd = self._inotify.add_watch(this.dir, _INSTANCE_DIR_MASK)
+            self._state.dir_watches[wd] = this
+            self._state.watched[this.dir] = wd
+            return False
+        except OSError:
+            return None
 
-    def process_default(self, event: Event):
-        if not event.pathname.endswith('/announce'):
-            self._logger.debug(f'Not an announce file: {event.pathname}')
+    def unwatch(self, this: InstanceDir):
+        """
+        Remove the watch on the announce file or directory of an instance, if there is one.
+        """
+        wd = self._state.watched.pop(this.dir, None)
+        if wd is None:
             return
-        if event.maskname == 'IN_MOVED_TO':
-            _dir = os.path.dirname(event.pathname)
-            if _dir in self._state.dirs:
-                self._state.dirs[_dir].reload()
-            else:
-                _timeout = self._args.timeout + (random.random() * 5) - 2.5  # spread polling intervals
-                this = InstanceDir(_dir, _timeout, self._logger)
-                self._state.dirs[_dir] = this
-                logger.info(f'Added instance {this}')
-        elif event.maskname == 'DELETE':
-            _dir = os.path.dirname(event.pathname)
-            if _dir in self._state.dirs:
-                self._state.dirs[_dir].withdraw()
-                this = self._state.dirs.pop(_dir)
-                logger.info(f'Removed instance {this}')
-        else:
-            self._logger.warning(f'Unhandled announce event: {event}')
+        self._state.file_watches.pop(wd, None)
+        self._state.dir_watches.pop(wd, None)
+        try:
+            self._inotify.rm_watch(wd)
+        except OSError:
+            # already removed by the kernel after IN_DELETE_SELF
+            pass
+
+    def schedule_reload(self, this: InstanceDir):
+        """
+        Reload the announce file of an instance after a short delay. Further events on the same
+        instance before then are covered by the already scheduled reload, since it reads whatever
+        is in the file when it runs.
+        """
+        if this.dir not in self._state.pending:
+            self._state.pending[this.dir] = self._loop.call_later(_RELOAD_DELAY, self._reload, this)
+
+    def _reload(self, this: InstanceDir):
+        del self._state.pending[this.dir]
+        this.reload()
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        """
+        Flush stdout once all callbacks of the current event loop iteration have run, so that
+        everything written to exabgp in one go (drained events, reloads firing at the same time)
+        goes out with a single write instead of one per instance.
+        """
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        sys.stdout.flush()
+
+    def _schedule_poll(self):
+        """
+        Sleep until the next instance is due for a scheduled poll, instead of waking up at
+        regular intervals to check.
+        """
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
+            self._poll_handle = None
+        if self._state.due:
+            next_poll = self._state.due[0][0]
+            self._poll_handle = self._loop.call_later(max(next_poll - time.time(), 0), self._poll)
+
+    def _poll(self):
+        self._poll_handle = None
+        now = time.time()
+        due = self._state.due
+        while due and due[0][0] <= now:
+            next_poll, _dir = heapq.heappop(due)
+            this = self._state.dirs.get(_dir)
+            if this is None or this.next_poll != next_poll:
+                # stale entry for a removed (or removed and re-added) instance
+                continue
+            this.poll(now)
+            heapq.heappush(due, (this.next_poll, _dir))
+        self._schedule_poll()
+        self._schedule_flush()
+
+    def _drain(self):
+        """
+        Called when the inotify fd is readable. Read all queued events into a preallocated buffer
+        and parse them in place, without creating an object for each event.
+
+        The queue is drained before returning to the event loop, so a burst of events larger than
+        the buffer doesn't cost one trip through the event loop per buffer full. A read that didn't
+        fill the buffer means the queue is empty, so there is normally no extra read() just to get EAGAIN.
+        """
+        fd = self._inotify.fileno()
+        buf = self._buf
+        while True:
+            try:
+                n = os.readv(fd, [buf])
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < n:
+                wd, mask, _cookie, name_len = _INOTIFY_EVENT.unpack_from(buf, pos)
+                pos += _INOTIFY_EVENT.size
+                name = bytes(buf[pos:pos + name_len]).rstrip(b'\0') if name_len else b''
+                pos += name_len
+                self.process_event(wd, mask, name)
+            if n <= len(buf) - _INOTIFY_EVENT_MAX:
+                break
+        self._schedule_flush()
+
+    def process_event(self, wd: int, mask: int, name: bytes):
+        if mask & flags.Q_OVERFLOW:
+            # Any kind of event might have been lost, so start over as if we had just started
+            self._logger.warning('Inotify event queue overflow, rescanning all instances')
+            added = set()
+            for this in self.scan():
+                self._logger.info('Added instance %s', this)
+                added.add(this.dir)
+            for this in self._state.dirs.values():
+                if this.dir not in added:
+                    self.unwatch(this)
+                    self.watch(this)
+                    self.schedule_reload(this)
+        elif wd == self._monitor_wd:
+            # Event on the top level directory, only instance directories coming and going are interesting
+            if not mask & flags.ISDIR:
+                return
+            _dir = os.path.join(self._args.monitor_dir, os.fsdecode(name))
+            if mask & (flags.CREATE | flags.MOVED_TO):
+                if _dir not in self._state.dirs:
+                    this = self.add_instance(_dir)
+                    self._logger.info('Added instance %s', this)
+            elif _dir in self._state.dirs:
+                self.remove_instance(self._state.dirs[_dir])
+        elif wd in self._state.dir_watches:
+            # A file was moved or written into an instance directory that didn't have an announce file
+            if name != b'announce':
+                return
+            this = self._state.dir_watches[wd]
+            self.unwatch(this)
+            if self.watch(this):
+                self.schedule_reload(this)
+        elif wd in self._state.file_watches:
+            this = self._state.file_watches[wd]
+            if mask & flags.CLOSE_WRITE:
+                # The announce file was written in place rather than replaced
+                self.schedule_reload(this)
+            elif mask & (flags.DELETE_SELF | flags.MOVE_SELF | flags.ATTRIB):
+                # The announce file was removed, or replaced by another file being renamed over it.
+                # After IN_MOVE_SELF or IN_ATTRIB, the watch follows the old inode so it has to be
+                # removed explicitly. A plain chmod or touch also ends up here, and just makes us
+                # reload an unchanged file.
+                self.unwatch(this)
+                watched = self.watch(this)
+                if watched:
+                    self.schedule_reload(this)
+                elif watched is None:
+                    # the instance directory is gone too
+                    self.remove_instance(this)
+                else:
+                    this.withdraw()
+        # Anything else is IN_IGNORED, or events for watches that have already been removed
 
 
 def main(args, logger):
-    wm = WatchManager()
     loop = asyncio.get_event_loop()
-    mask = (EventsCodes.ALL_FLAGS['IN_MOVED_TO'] |
-            EventsCodes.ALL_FLAGS['IN_CREATE'] |
-            EventsCodes.ALL_FLAGS['IN_DELETE']
-            )
+    # Commands to exabgp are flushed explicitly after each round of events, so give stdout a buffer
+    # large enough to hold the commands from a whole burst of updates
+    sys.stdout = open(sys.stdout.fileno(), 'w', buffering=1 << 16, closefd=False)
 
     state = State()
+    watcher = AnnounceWatcher(args, logger, state)
     # Add a monitor for each instance in the top level directory
-    for this in os.listdir(args.monitor_dir):
-        dir = os.path.join(args.monitor_dir, this)
-        if os.path.isdir(dir):
-            _timeout = args.timeout + (random.random() * 5) - 2.5  # spread polling intervals
-            this = InstanceDir(dir, _timeout, logger)
-            state.dirs[dir] = this
-            logger.debug(f'Startup added directory {this}')
-
-    notifier = AsyncioNotifier(wm, loop, default_proc_fun=AnnounceEvent(args, logger, state))
-    wm.add_watch(args.monitor_dir, mask, rec=True, auto_add=True)
+    for this in watcher.scan():
+        logger.debug('Startup added directory %s', this)
+    sys.stdout.flush()
+
+    watcher.start()
     loop.run_forever()
-    notifier.stop()
+    watcher.stop()
     return False
 
 